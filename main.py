@@ -1,14 +1,27 @@
 import os
+import time
 import uuid
+import hashlib
+import re
+import random
+import asyncio
 import shutil
+import zlib
 import fitz   # PyMuPDF
 import zipfile
 import tempfile
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import aiohttp
+import orjson
+import pybase64  # SIMD base64, drop-in for the stdlib module
+from typing import Dict, List, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from openai import OpenAI
 
 # =========================
 # INITIAL SETUP
@@ -25,15 +38,218 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+class GzipRequestMiddleware:
+    """
+    Inflate `Content-Encoding: gzip` request bodies before they reach the app.
+    Streams chunk by chunk with bounded output, so a large (or hostile) upload
+    never has to be decompressed in memory at once.
+    """
+
+    max_chunk = 1024 * 1024
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        encodings = [v.lower() for k, v in scope["headers"] if k == b"content-encoding"]
+        if encodings != [b"gzip"]:
+            return await self.app(scope, receive, send)
+
+        # The app sees a plain body of unknown length
+        headers = [(k, v) for k, v in scope["headers"] if k not in (b"content-encoding", b"content-length")]
+        scope = dict(scope, headers=headers)
+
+        inflater = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        input_done = False
+
+        def pending() -> bytes:
+            # Input already received but not yet inflated. After the end of a gzip
+            # member, leftover bytes sit in unused_data (unconsumed_tail goes stale).
+            return inflater.unused_data if inflater.eof else inflater.unconsumed_tail
+
+        async def inflate_receive():
+            nonlocal inflater, input_done
+            try:
+                if pending():
+                    src = pending()
+                    if inflater.eof:
+                        # Bytes after a finished member: the next member (multi-member gzip)
+                        inflater = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+                    data = inflater.decompress(src, self.max_chunk)
+                elif input_done:
+                    # Body already delivered — pass through (e.g. http.disconnect)
+                    return await receive()
+                else:
+                    message = await receive()
+                    if message["type"] != "http.request":
+                        return message
+                    input_done = not message.get("more_body", False)
+                    body = message.get("body", b"")
+                    if inflater.eof and body:
+                        inflater = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+                    data = inflater.decompress(body, self.max_chunk)
+
+                more_body = bool(pending()) or not input_done
+                if not more_body:
+                    data += inflater.flush()
+                    if not inflater.eof:
+                        raise zlib.error("truncated gzip stream")
+            except zlib.error:
+                raise HTTPException(status_code=400, detail="Invalid gzip request body.")
+
+            return {"type": "http.request", "body": data, "more_body": more_body}
+
+        await self.app(scope, inflate_receive, send)
+
+
+app.add_middleware(GzipRequestMiddleware)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+# Default Vision model (overridable per request via the `model` form field)
+OCR_MODEL = os.getenv("OCR_MODEL", "gpt-4o-mini")
+
+# Max number of Vision requests (batches) in flight per PDF — one OCR worker each
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "16"))
+
+# Process-wide request rate to OpenAI (requests / second)
+OCR_RPS = float(os.getenv("OCR_RPS", "8"))
+
+# Pages packed into one Vision request
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "4"))
+
+# Retry policy for rate-limit / transient errors
+OCR_MAX_RETRIES = 3
+OCR_BACKOFF_BASE = 1.0
+OCR_BACKOFF_CAP = 60.0
+
+# JPEG quality of the page image sent to Vision (PNG is kept for the bundle)
+VISION_JPEG_QUALITY = 85
+
+# Vision downsizes to ~2048px anyway, so it gets a lighter render than the bundle PNG
+VISION_DPI = int(os.getenv("VISION_DPI", "180"))
+ARCHIVE_DPI = int(os.getenv("ARCHIVE_DPI", "200"))
+
+# Pages whose embedded text layer has at least this many non-whitespace chars skip Vision
+NATIVE_TEXT_MIN_CHARS = int(os.getenv("NATIVE_TEXT_MIN_CHARS", "50"))
+
+# Include page PNGs in the bundle (media/images/)
+SAVE_IMAGES = os.getenv("SAVE_IMAGES", "true").lower() in ("1", "true", "yes")
+
+# Worker processes for PDF rasterization (0 = render in a single background thread)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+
+# Max batches waiting between pipeline stages (render → OCR → write)
+PIPELINE_QUEUE_SIZE = 4
+
+
+# Shared aiohttp session — reused across pages/requests so TLS handshakes amortize
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Lazily create the process-wide aiohttp session."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=64, limit_per_host=64)
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=120),
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        )
+    return _http_session
+
+
+@app.on_event("shutdown")
+async def close_http_session():
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+# Shared rasterization pool — page rendering is CPU-bound, so it runs out of process
+_render_pool: Optional[Executor] = None
+
+
+def get_render_pool() -> Executor:
+    """
+    Lazily create the rasterization pool.
+    Falls back to a single thread where multiprocessing is unavailable
+    (e.g. serverless runtimes without /dev/shm).
+    """
+    global _render_pool
+    if _render_pool is None:
+        if RENDER_WORKERS > 0:
+            try:
+                # Never fork: the pool is created lazily from a multi-threaded server process
+                ctx = multiprocessing.get_context("spawn")
+                _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=ctx)
+            except (OSError, NotImplementedError):
+                _render_pool = None
+        if _render_pool is None:
+            _render_pool = ThreadPoolExecutor(max_workers=1)
+    return _render_pool
+
+
+def reset_render_pool(pool: Executor):
+    """Drop a broken pool so the next get_render_pool() builds a fresh one."""
+    global _render_pool
+    if _render_pool is pool:
+        _render_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("shutdown")
+async def close_render_pool():
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursting up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+rate_limiter = TokenBucket(OCR_RPS)
 
 
 # =========================
 # MODELS
 # =========================
 
-class OCRResponse(BaseModel):
-    download_url: str
+class JobResponse(BaseModel):
+    job_id: str
+    status_url: str
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str  # queued | running | done | error
+    pages_total: Optional[int] = None
+    pages_done: Optional[int] = None
+    download_url: Optional[str] = None
+    error: Optional[str] = None
 
 
 # =========================
@@ -50,131 +266,571 @@ async def health():
     return {"status": "ok"}
 
 
+# =========================
+# HELPER — OPENAI CALL + RETRY
+# =========================
+
+def is_retryable(err: Exception) -> bool:
+    """Rate-limit (429), 5xx, timeouts and connection errors are worth retrying."""
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status == 429 or err.status >= 500 or "rate limit" in str(err).lower()
+    return isinstance(err, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+async def api_error(resp: aiohttp.ClientResponse) -> aiohttp.ClientResponseError:
+    """
+    Error for a failed OpenAI response, carrying OpenAI's own `error.message`
+    (e.g. an unknown model) rather than just the HTTP reason phrase.
+    """
+    message = resp.reason or ""
+    try:
+        message = orjson.loads(await resp.read())["error"]["message"]
+    except Exception:
+        pass
+
+    return aiohttp.ClientResponseError(
+        resp.request_info,
+        resp.history,
+        status=resp.status,
+        message=message,
+        headers=resp.headers,
+    )
+
+
+async def chat_completion(payload: dict) -> str:
+    """
+    POST to Chat Completions behind the token bucket,
+    with exponential backoff + jitter on retryable errors.
+    Returns the assistant message content.
+    """
+    # Serialized once (not per retry); the base64 images make this the bulk of the body
+    body = orjson.dumps(payload)
+
+    for attempt in range(OCR_MAX_RETRIES + 1):
+        await rate_limiter.acquire()
+        try:
+            async with get_http_session().post(
+                OPENAI_CHAT_URL,
+                data=body,
+                headers={"Content-Type": "application/json"},
+            ) as resp:
+                if resp.status >= 400:
+                    raise await api_error(resp)
+                result = await resp.json(loads=orjson.loads)
+
+            choice = result["choices"][0]
+            content = choice["message"].get("content")
+            if not isinstance(content, str):
+                # Content filter / refusal: no text for this request
+                raise ValueError(f"Vision returned no text (finish_reason={choice.get('finish_reason')!r})")
+            return content
+
+        except Exception as e:
+            if attempt == OCR_MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = min(OCR_BACKOFF_CAP, OCR_BACKOFF_BASE * 2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, OCR_BACKOFF_BASE))
+
+
 # =========================
 # HELPER — RUN OCR VISION
 # =========================
 
-async def run_vision_ocr(image_bytes: bytes, page_number: int):
+OCR_SYSTEM_PROMPT = "You are an OCR engine. Extract ALL visible text accurately."
+
+# Sentinels delimiting each page in a batched response
+BATCH_PAGE_RE = re.compile(r"<<<PAGE (\d+)>>>\n?(.*?)\n?<<<END>>>", re.DOTALL)
+
+
+def vision_payload(model: str, content: list) -> dict:
+    """Chat Completions body for one OCR request (deterministic decoding)."""
+    return {
+        "model": model,
+        "temperature": 0,
+        "top_p": 1,
+        "response_format": {"type": "text"},
+        "messages": [
+            {"role": "system", "content": OCR_SYSTEM_PROMPT},
+            {"role": "user", "content": content},
+        ],
+    }
+
+
+JPEG_DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+
+
+def image_part(image_bytes: bytes) -> dict:
+    """Chat Completions content part for a JPEG page image."""
+    # Join prefix + base64 as bytes and decode once, instead of decoding
+    # then copying the multi-hundred-KB string again for the prefix
+    image_url = (JPEG_DATA_URL_PREFIX + pybase64.b64encode(image_bytes)).decode("ascii")
+    return {"type": "image_url", "image_url": {"url": image_url}}
+
+
+async def run_vision_ocr(image_bytes: bytes, page_number: int, model: str = OCR_MODEL):
     """
     Calls OpenAI Vision to generate OCR text.
     Returns pure text.
     """
-    result = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are an OCR engine. Extract ALL visible text accurately."},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": f"OCR page {page_number}. Return plain text only."},
-                    {"type": "input_image", "image_url": f"data:image/png;base64,{image_bytes.decode('latin1')}"}
-                ]
-            }
-        ]
+    payload = vision_payload(model, [
+        {"type": "text", "text": f"OCR page {page_number}. Return plain text only."},
+        image_part(image_bytes),
+    ])
+
+    return await chat_completion(payload)
+
+
+def split_batch_text(text: str, page_numbers: List[int]) -> List[str]:
+    """Split a batched response into per-page texts; ValueError if pages are missing."""
+    pages = {int(n): body.strip() for n, body in BATCH_PAGE_RE.findall(text)}
+    if any(n not in pages for n in page_numbers):
+        raise ValueError("batched OCR response is missing page sentinels")
+    return [pages[n] for n in page_numbers]
+
+
+async def run_vision_ocr_batch(images: List[bytes], page_numbers: List[int], model: str = OCR_MODEL) -> list:
+    """
+    OCR several pages in a single Vision request.
+    Returns one entry per page: the text, or the exception if that page failed.
+    Falls back to one request per page if the response can't be split.
+    """
+    if len(images) == 1:
+        return [await run_vision_ocr(images[0], page_numbers[0], model)]
+
+    instructions = (
+        f"OCR pages {', '.join(map(str, page_numbers))}, one image per page in this order. "
+        "Return plain text only, each page wrapped as:\n"
+        "<<<PAGE n>>>\n...text...\n<<<END>>>"
     )
 
-    return result.choices[0].message["content"]
+    payload = vision_payload(model, [{"type": "text", "text": instructions}] + [image_part(img) for img in images])
+
+    try:
+        return split_batch_text(await chat_completion(payload), page_numbers)
+    except ValueError:
+        return list(await asyncio.gather(
+            *(run_vision_ocr(img, page_num, model) for img, page_num in zip(images, page_numbers)),
+            return_exceptions=True,
+        ))
 
 
 # =========================
-# BUILD OCR ZIP BUNDLE
+# HELPER — RENDER PDF PAGE
 # =========================
 
-def build_zip_bundle(base_dir: str, zip_path: str):
-    """Zip toàn bộ bundle."""
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
-        for root, _, files in os.walk(base_dir):
-            for f in files:
-                full = os.path.join(root, f)
-                rel = os.path.relpath(full, base_dir)
-                z.write(full, rel)
+def count_pages(pdf_path: str) -> int:
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+# Document opened by this worker, reused across pages of the same PDF
+_worker_doc = None
+
+
+def render_page(pdf_path: str, page_index: int):
+    """
+    Runs inside a render worker: prepare one page.
+    Returns (native_text, png_bytes, jpeg_bytes):
+      - native_text: the embedded text layer if it is usable, else None
+      - png_bytes: PNG at ARCHIVE_DPI for the bundle (None if SAVE_IMAGES is off)
+      - jpeg_bytes: JPEG at VISION_DPI for Vision (None if native_text is used)
+    """
+    global _worker_doc
+    # Each worker opens the PDF itself; an open fitz.Document can't be shared
+    if _worker_doc is None or _worker_doc.name != pdf_path:
+        if _worker_doc is not None:
+            _worker_doc.close()
+        _worker_doc = fitz.open(pdf_path)
+
+    page = _worker_doc[page_index]
+
+    # Check before render: a real text layer makes Vision unnecessary
+    native_text = page.get_text("text").strip()
+    if len("".join(native_text.split())) < NATIVE_TEXT_MIN_CHARS:
+        native_text = None
+    elif not SAVE_IMAGES:
+        return native_text, None, None
+
+    # No bundle PNG → nothing needs the archive resolution; render straight at VISION_DPI
+    if not SAVE_IMAGES:
+        pix = page.get_pixmap(dpi=VISION_DPI)
+        return None, None, pix.tobytes("jpeg", jpg_quality=VISION_JPEG_QUALITY)
+
+    pix = page.get_pixmap(dpi=ARCHIVE_DPI)
+    png_bytes = pix.tobytes("png")
+    if native_text is not None:
+        return native_text, png_bytes, None
+
+    # Derive the Vision image by scaling the archive pixmap instead of re-rendering
+    if VISION_DPI != ARCHIVE_DPI:
+        scale = VISION_DPI / ARCHIVE_DPI
+        pix = fitz.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)), None)
+
+    return None, png_bytes, pix.tobytes("jpeg", jpg_quality=VISION_JPEG_QUALITY)
+
+
+async def render_pages(pdf_path: str, page_nums: List[int]) -> list:
+    """
+    Run render_page for each page in the render pool.
+    Returns one entry per page: render_page's tuple, or the exception for that page.
+    If a worker dies (OOM, MuPDF crash) the pool is rebuilt and the batch retried
+    once; a second BrokenProcessPool propagates and fails the job.
+    """
+    loop = asyncio.get_running_loop()
+
+    for _ in range(2):
+        pool = get_render_pool()
+
+        async def submit(page_num: int):
+            return await loop.run_in_executor(pool, render_page, pdf_path, page_num - 1)
+
+        results = await asyncio.gather(*(submit(n) for n in page_nums), return_exceptions=True)
+        broken = next((r for r in results if isinstance(r, BrokenProcessPool)), None)
+        if broken is None:
+            return results
+        reset_render_pool(pool)
+
+    raise broken
 
 
 # =========================
-# OCR PDF ENDPOINT
+# BUILD OCR ZIP BUNDLE
 # =========================
 
-@app.post("/ocr/pdf", response_model=OCRResponse)
-async def ocr_pdf(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="File must be a PDF.")
+STORED_EXTENSIONS = (".png", ".jpg", ".jpeg")
 
-    # Create temp workspace (serverless-compatible)
-    work_id = str(uuid.uuid4())
-    tmp_root = os.path.join("/tmp", work_id)
-    docs_dir = os.path.join(tmp_root, "docs")
-    media_dir = os.path.join(tmp_root, "media", "images")
-    tables_dir = os.path.join(tmp_root, "tables")
 
-    os.makedirs(docs_dir, exist_ok=True)
-    os.makedirs(media_dir, exist_ok=True)
-    os.makedirs(tables_dir, exist_ok=True)
+class ZipBundle:
+    """
+    Bundle ZIP được ghi dần: mỗi artifact được thêm vào ngay khi có,
+    không cần thư mục tạm + os.walk ở cuối.
+    """
 
-    pdf_path = os.path.join(tmp_root, "input.pdf")
+    def __init__(self, zip_path: str):
+        # Large write buffer: many small local/central headers between the big entries
+        self._file = open(zip_path, "wb", buffering=1024 * 1024)
+        self._zf = zipfile.ZipFile(self._file, "w", zipfile.ZIP_DEFLATED, compresslevel=1)
+        self._lock = asyncio.Lock()  # ZipFile is not safe for concurrent writers
+
+    async def add(self, name: str, data):
+        # PNG/JPEG are already compressed — deflating them again only burns CPU
+        if name.lower().endswith(STORED_EXTENSIONS):
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
 
-    # Save uploaded file
-    with open(pdf_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            await loop.run_in_executor(None, self._zf.writestr, name, data, compress_type)
 
-    # Load PDF
-    doc = fitz.open(pdf_path)
+    def close(self):
+        self._zf.close()
+        self._file.close()
 
-    raw_text_all = ""
+
+async def build_bundle(pdf_path: str, zip_out: str, model: str, progress: Optional[dict] = None):
+    """
+    OCR every page of `pdf_path` and write the bundle ZIP to `zip_out`.
+
+    Three stages connected by bounded queues, so rendering, Vision calls and
+    ZIP writes overlap and a slow OpenAI applies backpressure to rendering:
+      rasterize_worker → ocr_q → ocr_worker → write_q → writer
+
+    `progress` (if given) gets "pages_total" / "pages_done" updated live.
+    """
+    # Load PDF (pages are rendered by the worker pool)
+    page_count = await asyncio.to_thread(count_pages, pdf_path)
+    if progress is not None:
+        progress.update(pages_total=page_count, pages_done=0)
+
+    bundle = ZipBundle(zip_out)
+
+    raw_text_parts = []  # joined once at the end — one write instead of a concat per page
+    texts = {}  # page_num → OCR text, or the exception for that page
     warnings = []
+    sources = {}  # page_num → "pdf_text" | "render_error" (page not sent to Vision)
+    write_errors = []
+    ocr_cache = {}  # blake2b(jpeg) → future of its OCR text (or exception)
+
+    loop = asyncio.get_running_loop()
+
+    batch_q = asyncio.Queue()
+    for start in range(1, page_count + 1, OCR_BATCH_SIZE):
+        batch_q.put_nowait(list(range(start, min(start + OCR_BATCH_SIZE, page_count + 1))))
+
+    ocr_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_q = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    async def rasterize_worker():
+        # Stage 1: render a batch in the worker pool, hand PNGs to the writer
+        while not batch_q.empty():
+            page_nums = batch_q.get_nowait()
+            rendered = await render_pages(pdf_path, page_nums)
+
+            pages = []
+            for page_num, result in zip(page_nums, rendered):
+                if isinstance(result, OSError):
+                    raise result  # infrastructure (disk, pool, missing PDF) — fail the job
+                if isinstance(result, Exception):
+                    # This page alone couldn't be rendered; it never reaches Vision
+                    sources[page_num] = "render_error"
+                    await write_q.put(("text", page_num, result))
+                    continue
+
+                native_text, png_bytes, jpeg_bytes = result
+                if png_bytes is not None:
+                    await write_q.put(("png", page_num, png_bytes))
+                pages.append((page_num, native_text, jpeg_bytes))
+            del rendered
+
+            await ocr_q.put(pages)
+
+    async def ocr_worker():
+        # Stage 2: Vision OCR for pages without a usable text layer
+        while (pages := await ocr_q.get()) is not None:
+            ocr_pages, jpegs, pending = [], [], []
+            duplicates = []  # (page_num, future of an identical page already being OCR'd)
+            for page_num, native_text, jpeg_bytes in pages:
+                if native_text is not None:
+                    sources[page_num] = "pdf_text"
+                    await write_q.put(("text", page_num, native_text))
+                    continue
+
+                # Identical pages (blank separators, repeated forms) are OCR'd once per job
+                key = hashlib.blake2b(jpeg_bytes, digest_size=16).digest()
+                if key in ocr_cache:
+                    duplicates.append((page_num, ocr_cache[key]))
+                    continue
+
+                ocr_cache[key] = loop.create_future()
+                pending.append(ocr_cache[key])
+                ocr_pages.append(page_num)
+                jpegs.append(jpeg_bytes)
+            del pages
+
+            if ocr_pages:
+                try:
+                    ocr_texts = await run_vision_ocr_batch(jpegs, ocr_pages, model)
+                except Exception as e:
+                    ocr_texts = [e] * len(ocr_pages)
+                del jpegs
+
+                for page_num, fut, ocr_text in zip(ocr_pages, pending, ocr_texts):
+                    fut.set_result(ocr_text)
+                    await write_q.put(("text", page_num, ocr_text))
+
+            for page_num, fut in duplicates:
+                await write_q.put(("text", page_num, await fut))
+
+    async def writer():
+        # Stage 3: single consumer — the only coroutine touching the ZIP during OCR.
+        # Keeps draining after a failed write so upstream stages never block on a full queue.
+        while (item := await write_q.get()) is not None:
+            kind, page_num, data = item
+            if kind == "text":
+                texts[page_num] = data
+                if progress is not None:
+                    progress["pages_done"] += 1
+            elif not write_errors:
+                try:
+                    await bundle.add(f"media/images/page_{page_num}.png", data)
+                except Exception as e:
+                    write_errors.append(e)
+
+    async def drain_in_order():
+        # Each stage is told to stop only once the stage feeding it has finished
+        await asyncio.gather(*rasterizers)
+        for _ in ocr_workers:
+            await ocr_q.put(None)
+        await asyncio.gather(*ocr_workers)
+        await write_q.put(None)
+        await writer_task
+
+    rasterizers = [asyncio.create_task(rasterize_worker()) for _ in range(max(1, RENDER_WORKERS))]
+    ocr_workers = [asyncio.create_task(ocr_worker()) for _ in range(OCR_MAX_CONCURRENCY)]
+    writer_task = asyncio.create_task(writer())
+    all_tasks = rasterizers + ocr_workers + [writer_task, asyncio.create_task(drain_in_order())]
+
+    try:
+        # Fail fast if any stage dies, rather than leaving the others blocked on a queue
+        done, _ = await asyncio.wait(all_tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        if write_errors:
+            raise write_errors[0]
+
+        for page_num in range(1, page_count + 1):
+            ocr_text = texts.get(page_num, "")
+            if isinstance(ocr_text, Exception):
+                stage = "render" if sources.get(page_num) == "render_error" else "OCR"
+                warnings.append(f"Page {page_num} {stage} error: {str(ocr_text)}")
+                ocr_text = ""
+
+            raw_text_parts.append(f"\n\n# PAGE {page_num}\n" + ocr_text)
+
+        # raw_text.md
+        await bundle.add("docs/raw_text.md", "".join(raw_text_parts))
+
+        # structure.json
+        structure = {
+            "pages": page_count,
+            "page_sources": [
+                {"page": page_num, "source": sources.get(page_num, "vision_ocr")}
+                for page_num in range(1, page_count + 1)
+            ],
+        }
+        await bundle.add("docs/structure.json", orjson.dumps(structure, option=orjson.OPT_INDENT_2))
+
+        # ocr_warnings.txt
+        await bundle.add("docs/ocr_warnings.txt", "\n".join(warnings))
+
+    finally:
+        for task in all_tasks:
+            task.cancel()
+        bundle.close()
+
+
+# =========================
+# JOBS
+# =========================
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def save_upload(src, dest_path: str):
+    """Copy the multipart body to disk chunk by chunk — constant memory for any PDF size."""
+    with open(dest_path, "wb") as f:
+        shutil.copyfileobj(src, f, UPLOAD_CHUNK_SIZE)
 
-    # Iterate pages
-    for i, page in enumerate(doc):
-        page_num = i + 1
 
-        # Render page → PNG bytes
-        pix = page.get_pixmap(dpi=200)
-        img_bytes = pix.tobytes("png")
+# Finished jobs (and their /tmp/<job_id> bundle) are kept this long for download
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
 
-        # Save PNG file
-        img_out = os.path.join(media_dir, f"page_{page_num}.png")
-        pix.save(img_out)
+# Serverless functions are frozen once the response is sent and don't share memory
+# between instances, so on Vercel the ZIP is always built inside the request
+SYNC_ONLY = bool(os.getenv("VERCEL"))
 
-        # OCR via OpenAI Vision
+# In-memory job store: job_id → {"status", "tmp_root", "zip_path", "error", "finished_at", "task"}
+jobs: Dict[str, dict] = {}
+
+
+async def run_job(job_id: str, pdf_path: str, zip_out: str, model: str):
+    job = jobs[job_id]
+    job["status"] = "running"
+    try:
+        await build_bundle(pdf_path, zip_out, model, progress=job)
+        job["status"] = "done"
+    except Exception as e:
+        job["status"] = "error"
+        job["error"] = str(e)
+    finally:
+        # Only the ZIP is needed from here on
         try:
-            ocr_text = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "OCR engine. Extract ALL text accurately."},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "input_text", "text": f"OCR page {page_num}. Return plain text only."},
-                            {
-                                "type": "input_image",
-                                "image_url": f"data:image/png;base64,{img_bytes.decode('latin1')}"
-                            }
-                        ]
-                    }
-                ]
-            ).choices[0].message["content"]
+            os.remove(pdf_path)
+        except FileNotFoundError:
+            pass
+        job["finished_at"] = time.monotonic()
+        job.pop("task", None)
 
-        except Exception as e:
-            ocr_text = ""
-            warnings.append(f"Page {page_num} OCR error: {str(e)}")
 
-        raw_text_all += f"\n\n# PAGE {page_num}\n" + ocr_text
+async def evict_expired_jobs():
+    """Forget jobs that finished more than JOB_TTL_SECONDS ago and delete their workspace."""
+    now = time.monotonic()
+    expired = [
+        job_id for job_id, job in jobs.items()
+        if job.get("finished_at") is not None and now - job["finished_at"] > JOB_TTL_SECONDS
+    ]
+    tmp_roots = [jobs.pop(job_id)["tmp_root"] for job_id in expired]
+
+    def remove_all():
+        for tmp_root in tmp_roots:
+            shutil.rmtree(tmp_root, ignore_errors=True)
 
-    # Save raw_text.md
-    with open(os.path.join(docs_dir, "raw_text.md"), "w", encoding="utf-8") as f:
-        f.write(raw_text_all)
+    if tmp_roots:
+        await asyncio.to_thread(remove_all)
 
-    # Save structure.json
-    with open(os.path.join(docs_dir, "structure.json"), "w", encoding="utf-8") as f:
-        f.write('{"pages": ' + str(doc.page_count) + '}')
 
-    # Save warnings
-    with open(os.path.join(docs_dir, "ocr_warnings.txt"), "w", encoding="utf-8") as f:
-        f.write("\n".join(warnings))
+# =========================
+# OCR PDF ENDPOINT
+# =========================
+
+@app.post(
+    "/ocr/pdf",
+    response_model=JobResponse,
+    status_code=202,
+    responses={200: {"content": {"application/zip": {}}, "description": "ZIP bundle (wait=true or on Vercel)"}},
+)
+async def ocr_pdf(
+    request: Request,
+    file: UploadFile = File(...),
+    model: Optional[str] = Form(None),
+    wait: bool = False,
+):
+    if not file.filename.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="File must be a PDF.")
+
+    await evict_expired_jobs()
+
+    # Create temp workspace (serverless-compatible)
+    job_id = str(uuid.uuid4())
+    tmp_root = os.path.join("/tmp", job_id)
+    os.makedirs(tmp_root, exist_ok=True)
 
-    # Build ZIP
+    pdf_path = os.path.join(tmp_root, "input.pdf")
     zip_out = os.path.join(tmp_root, "bundle.zip")
-    build_zip_bundle(tmp_root, zip_out)
 
-    # Return downloadable URL
+    # Save uploaded file (streamed in 1 MB chunks, off the event loop)
+    await asyncio.to_thread(save_upload, file.file, pdf_path)
+
+    if wait or SYNC_ONLY:
+        # Build inside the request and return the ZIP directly
+        try:
+            await build_bundle(pdf_path, zip_out, model or OCR_MODEL)
+        except Exception as e:
+            await asyncio.to_thread(shutil.rmtree, tmp_root, ignore_errors=True)
+            raise HTTPException(status_code=500, detail=f"OCR failed: {e}")
+        return FileResponse(
+            zip_out,
+            media_type="application/zip",
+            filename="ocr_bundle.zip",
+            background=BackgroundTask(shutil.rmtree, tmp_root, ignore_errors=True),
+        )
+
+    # Build the bundle in the background; the client polls the status URL
+    jobs[job_id] = {"status": "queued", "tmp_root": tmp_root, "zip_path": zip_out, "error": None, "finished_at": None}
+    jobs[job_id]["task"] = asyncio.create_task(run_job(job_id, pdf_path, zip_out, model or OCR_MODEL))
+
+    return JobResponse(job_id=job_id, status_url=str(request.url_for("job_status", job_id=job_id)))
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def job_status(request: Request, job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    download_url = None
+    if job["status"] == "done":
+        download_url = str(request.url_for("job_download", job_id=job_id))
+
+    return JobStatus(
+        job_id=job_id,
+        status=job["status"],
+        pages_total=job.get("pages_total"),
+        pages_done=job.get("pages_done"),
+        download_url=download_url,
+        error=job["error"],
+    )
+
+
+@app.get("/jobs/{job_id}/download")
+async def job_download(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}.")
+
     # Vercel serves static files via /api or /files – we use on-demand FileResponse fallback
-    return FileResponse(zip_out, filename="ocr_bundle.zip")
+    return FileResponse(job["zip_path"], filename="ocr_bundle.zip")
@@ -0,0 +1,79 @@
+import asyncio
+import gzip
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from main import GzipRequestMiddleware
+
+MAX_CHUNK = GzipRequestMiddleware.max_chunk
+
+
+def run_middleware(body: bytes, chunk_size: int = 64 * 1024, extra_receives: int = 0):
+    """Feed a gzip body through the middleware; return the body messages the app received."""
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    incoming = [
+        {"type": "http.request", "body": c, "more_body": n < len(chunks) - 1}
+        for n, c in enumerate(chunks)
+    ] + [{"type": "http.disconnect"}]
+    incoming = iter(incoming)
+    received = []
+
+    async def receive():
+        return next(incoming)
+
+    async def app(scope, receive, send):
+        assert (b"content-encoding", b"gzip") not in scope["headers"]
+        while True:
+            message = await receive()
+            received.append(message)
+            assert len(message["body"]) <= 2 * MAX_CHUNK
+            assert len(received) < 10_000, "middleware keeps returning messages without progress"
+            if not message["more_body"]:
+                break
+        for _ in range(extra_receives):
+            received.append(await receive())
+
+    scope = {"type": "http", "headers": [(b"content-encoding", b"gzip"), (b"content-length", b"1")]}
+    asyncio.run(GzipRequestMiddleware(app)(scope, receive, None))
+    return received
+
+
+def body_of(messages) -> bytes:
+    return b"".join(m["body"] for m in messages if m["type"] == "http.request")
+
+
+def test_roundtrip_large_body():
+    raw = os.urandom(300_000) + b"\0" * (3 * MAX_CHUNK)
+    messages = run_middleware(gzip.compress(raw))
+    assert body_of(messages) == raw
+
+
+def test_multi_member_small():
+    a, b = b"first member " * 100, b"second member " * 100
+    assert body_of(run_middleware(gzip.compress(a) + gzip.compress(b))) == a + b
+
+
+def test_multi_member_larger_than_max_chunk():
+    a, b = b"\0" * (2 * MAX_CHUNK), b"\1" * (2 * MAX_CHUNK)
+    assert body_of(run_middleware(gzip.compress(a) + gzip.compress(b))) == a + b
+
+
+def test_trailing_garbage_after_large_member_is_rejected():
+    body = gzip.compress(b"\0" * (2 * MAX_CHUNK)) + b"x"
+    with pytest.raises(HTTPException) as exc:
+        run_middleware(body)
+    assert exc.value.status_code == 400
+
+
+def test_truncated_stream_is_rejected():
+    body = gzip.compress(os.urandom(200_000))
+    with pytest.raises(HTTPException) as exc:
+        run_middleware(body[: len(body) // 2])
+    assert exc.value.status_code == 400
+
+
+def test_disconnect_passes_through_after_body():
+    messages = run_middleware(gzip.compress(b"pdf bytes"), extra_receives=1)
+    assert messages[-1] == {"type": "http.disconnect"}